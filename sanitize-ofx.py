@@ -4,16 +4,31 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import contextvars
+import dataclasses
 import datetime as _dt
+import decimal
+import functools
+import itertools
 import logging
+import mmap
+import os
 import re
+import shutil
 import sys
+import time
 import unicodedata
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import Callable, Dict, Iterable, Iterator, List, TextIO, Tuple
 import xml.etree.ElementTree as ET
 
 _LOG = logging.getLogger(__name__)
+# Turns a whole document into sanitized text, or writes it to a stream when one is given
+_Converter = Callable[[str, TextIO | None], str | None]
+# Recurring per-field problems, reported as one summary line each per document. Each
+# conversion sets its own counter, so concurrent calls never mix or clear each other's
+_WARNINGS: contextvars.ContextVar[collections.Counter[str]] = contextvars.ContextVar("_WARNINGS")
 
 _HEADER_TEMPLATE = [
     "OFXHEADER:100",
@@ -27,7 +42,14 @@ _HEADER_TEMPLATE = [
     "NEWFILEUID:NONE",
     "",
 ]
+# What an OFX document without any content renders to
+_CANONICAL_HEADER = "\r\n".join(_HEADER_TEMPLATE) + "\r\n"
 
+# Rendered !Type headers for the account types Money knows, keyed by lowercased type
+_QIF_TYPE_HEADERS = {
+    value.lower(): f"!Type:{value}" for value in ("BANK", "CASH", "CCARD", "INVST", "OTH A", "OTH L", "INVOICE")
+}
+_QIF_TYPE_HEADERS[""] = _QIF_TYPE_HEADERS["bank"]
 _ALLOWED_QIF_TAGS = {
     "D",
     "T",
@@ -43,6 +65,9 @@ _ALLOWED_QIF_TAGS = {
     "^",
 }
 
+# Tried in order; the first format that parses wins for ambiguous dates
+_DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+
 _PAYEE_LIMIT = 80
 _MEMO_LIMIT = 120
 _ADDRESS_LIMIT = 35
@@ -56,28 +81,177 @@ _OFX_TAG_LIMITS = {
     "FID": 32,
 }
 
+_BALANCE_TAGS = {"LEDGERBAL", "AVAILBAL"}
+# Small aggregates buffered whole while streaming and written at their end tag
+_BUFFERED_TAGS = {"STMTTRN", "SONRS"} | _BALANCE_TAGS
+# Tags whose text is document context: the TRNUID fallback, the bank ID and the statement end
+_CONTEXT_TAGS = {"FITID", "BANKID", "DTEND"}
+
+_AMP_RE = re.compile(r"&(?!amp;|lt;|gt;|apos;|quot;)")
+# One tag plus the text that follows it, up to the next "<". The lookahead keeps the
+# name atomic: it cannot give characters back to the suffix, so a stray "<" before a
+# long run of name characters fails in linear time instead of backtracking
+_OFX_TOKEN_RE = re.compile(r"<(/?)([A-Za-z0-9_.+-]*)(?![A-Za-z0-9_.+-])([^<>]*)>([^<]*)")
+# Rest of a tag name the tokenizer stopped short of, up to whitespace or "/"
+_NAME_TAIL_RE = re.compile(r"[^\s/]*")
+# OFX/QFX put the root tag right after a short header; look no further than this
+_SIGNATURE_WINDOW = 4096
+# Files at least this large are memory-mapped rather than read into a bytes object
+_MMAP_THRESHOLD = 1 << 20
+# Preprocessed pieces (tags and text runs) handed to the XML parser per feed() call
+_FEED_PIECES = 4096
+_OFX_SIGNATURE_RE = re.compile(r"<OFX", re.IGNORECASE)
+_OFX_SUFFIXES = {".ofx", ".qfx"}
+# Amounts that need real parsing round half-up to cents, like a bank statement would.
+# Only exact operations (quantize, scaleb) run in it, on magnitudes _parse_decimal bounded.
+_DECIMAL_CONTEXT = decimal.Context(prec=decimal.MAX_PREC, rounding=decimal.ROUND_HALF_UP)
+_CENT = decimal.Decimal("0.01")
+# No real amount has more integer digits; larger values (e.g. "1e5000") are rejected
+_AMOUNT_MAX_DIGITS = 100
+_DIGITS_RE = re.compile(r"[^0-9]")
+_AMOUNT_FIX_RE = re.compile(r"[^0-9.-]")
+
+
+# Line breaks and the QIF record separator become plain spaces
+_TRANS = str.maketrans({"\r": " ", "\n": " ", "^": " "})
+
+
+def _warn(summary: str, message: str, *args: object) -> None:
+    """Count a recurring problem under ``summary``; the details are logged at DEBUG."""
+    counter = _WARNINGS.get(None)
+    if counter is None:
+        # A helper used on its own, outside any document: nothing will summarize it
+        _LOG.warning(message, *args)
+        return
+    counter[summary] += 1
+    if _LOG.isEnabledFor(logging.DEBUG):
+        _LOG.debug(message, *args)
 
-def _ascii(text: str) -> str:
-    """Return a Money-safe ASCII string."""
-    normalized = unicodedata.normalize("NFKD", text)
-    ascii_bytes = normalized.encode("ascii", "ignore")
-    cleaned = ascii_bytes.decode("ascii", "ignore")
-    cleaned = cleaned.replace("\r", " ").replace("\n", " ")
-    cleaned = cleaned.replace("^", " ")
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
-    return cleaned
 
+def _log_warnings(warnings: Iterable[Tuple[str, int]]) -> None:
+    for summary, count in warnings:
+        _LOG.warning("%s: %d", summary, count)
 
-def _sanitize_date(raw: str) -> str:
-    candidates = ["%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"]
-    for pattern in candidates:
+
+# Payees and memos repeat heavily within a statement, so folded results are cached
+@functools.lru_cache(maxsize=4096)
+def _fold_ascii(text: str) -> str:
+    """Decompose accented characters and drop whatever is still not ASCII."""
+    # Already-decomposed text (and many symbol-only strings) passes the quick check
+    if not unicodedata.is_normalized("NFKD", text):
+        text = unicodedata.normalize("NFKD", text)
+    # The encode/decode round trip beats str.translate with a drop-everything-above-127
+    # table by a wide margin; the bytes are pure ASCII so the decode cannot fail
+    return text.encode("ascii", "ignore").decode("ascii")
+
+
+def _ascii(text: str) -> str:
+    """Return a Money-safe ASCII string."""
+    if text.isascii():
+        # Bank feeds are overwhelmingly ASCII already; skip NFKD entirely
+        cleaned = text.translate(_TRANS)
+    else:
+        cleaned = _fold_ascii(text).translate(_TRANS)
+    return " ".join(cleaned.split())
+
+
+def _money_us_date(raw: str) -> str | None:
+    """Rewrite ``MM/DD/YYYY`` as Money's ``MM/DD'YY`` by slicing, avoiding ``_strptime``."""
+    parts = raw.split("/")
+    if len(parts) != 3:
+        return None
+    month, day, year = parts
+    if not (0 < len(month) <= 2 and 0 < len(day) <= 2 and len(year) == 4):
+        return None
+    digits = month + day + year
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    try:
+        # Only validates the calendar date; the output is built from the parts
+        _dt.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+    return f"{month.zfill(2)}/{day.zfill(2)}'{year[2:]}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date_cached(raw: str) -> str | None:
+    # Statements repeat the same posting dates many times over
+    formatted = _money_us_date(raw)
+    if formatted is not None:
+        return formatted
+    for pattern in _DATE_FORMATS:
         try:
-            parsed = _dt.datetime.strptime(raw.strip(), pattern)
-            return parsed.strftime("%m/%d'%y")
+            return _dt.datetime.strptime(raw, pattern).strftime("%m/%d'%y")
         except ValueError:
             continue
-    _LOG.warning("Unrecognized date '%s'; leaving as-is", raw)
-    return raw.strip()
+    return None
+
+
+def _sanitize_date(raw: str) -> str:
+    cleaned = raw.strip()
+    sanitized = _parse_date_cached(cleaned)
+    if sanitized is None:
+        _warn("Unrecognized dates left as-is", "Unrecognized date '%s'; leaving as-is", raw)
+        return cleaned
+    return sanitized
+
+
+def _parse_decimal(text: str) -> decimal.Decimal | None:
+    """Return an amount rounded to cents, or None when ``text`` is not a number at all.
+
+    Numbers no statement can hold (NaN, infinities, more integer digits than
+    ``_AMOUNT_MAX_DIGITS``) raise ValueError instead of being coerced.
+    """
+    try:
+        value = decimal.Decimal(text)
+    except decimal.InvalidOperation:
+        return None
+    try:
+        # An exponent can name a magnitude past Decimal's Emax or int()/str() digit limits
+        if value.is_finite() and value.adjusted() < _AMOUNT_MAX_DIGITS:
+            return value.quantize(_CENT, context=_DECIMAL_CONTEXT)
+    except decimal.DecimalException:
+        pass
+    raise ValueError(f"Unparseable amount '{text}'")
+
+
+def _split_plain_amount(text: str) -> Tuple[bool, str, str] | None:
+    """Split a plain ``[+-]digits[.d[d]]`` amount into its sign, whole digits and two cent digits.
+
+    Leading zeros are dropped from the whole digits. As in ``_parse_decimal``, more
+    than ``_AMOUNT_MAX_DIGITS`` of them raise ValueError.
+    """
+    negative = text.startswith("-")
+    whole, _, fraction = (text[1:] if negative or text.startswith("+") else text).partition(".")
+    digits = whole + fraction
+    if len(fraction) <= 2 and digits.isdigit() and digits.isascii():
+        whole = whole.lstrip("0")
+        if len(whole) > _AMOUNT_MAX_DIGITS:
+            raise ValueError(f"Unparseable amount '{text}'")
+        return negative, whole, fraction.ljust(2, "0")
+    return None
+
+
+def _amount_cents(text: str) -> int | None:
+    """Return an amount in integer cents, or None when it cannot be parsed."""
+    try:
+        plain = _split_plain_amount(text)
+        if plain is None:
+            value = _parse_decimal(text)
+            return None if value is None else int(value.scaleb(2, _DECIMAL_CONTEXT))
+    except ValueError:
+        # Rejected amounts never reach the output; rendering their TRNAMT raises too
+        return None
+    negative, whole, cents = plain
+    value = int(whole + cents)
+    return -value if negative else value
+
+
+def _format_cents(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    units, cents = divmod(abs(cents), 100)
+    return f"{sign}{units}.{cents:02d}"
 
 
 def _sanitize_amount(raw: str) -> str:
@@ -85,31 +259,53 @@ def _sanitize_amount(raw: str) -> str:
     cleaned = cleaned.replace("+", "")
     if cleaned in {"", "-"}:
         return "0.00"
-    try:
-        value = float(cleaned)
-    except ValueError:  # fallback for stray characters
-        cleaned = re.sub(r"[^0-9.-]", "", cleaned)
-        value = float(cleaned or 0.0)
-        _LOG.warning("Amount needed coercion from '%s'", raw)
-    return f"{value:.2f}"
+    plain = _split_plain_amount(cleaned)
+    if plain is not None:
+        # Plain decimal: reformat the digits directly instead of a float round trip
+        negative, whole, cents = plain
+        return f"{'-' if negative else ''}{whole or '0'}.{cents}"
+    value = _parse_decimal(cleaned)
+    if value is None:  # fallback for stray characters
+        value = _parse_decimal(_AMOUNT_FIX_RE.sub("", cleaned) or "0")
+        if value is None:
+            raise ValueError(f"Unparseable amount '{raw}'")
+        _warn("Amounts needing coercion", "Amount needed coercion from '%s'", raw)
+    return f"{value:f}"
 
 
 def _trim(text: str, limit: int) -> str:
     if len(text) <= limit:
         return text
-    _LOG.warning("Truncating field '%s' to %d characters", text, limit)
+    _warn("Fields truncated to Money's length limits", "Truncating field '%s' to %d characters", text, limit)
     return text[:limit]
 
 
+def _trimmed_ascii(limit: int, raw: str) -> str:
+    return _trim(_ascii(raw), limit)
+
+
+# Single-value QIF fields after D/T, in the order Money expects them
+_QIF_FIELDS = (
+    ("P", functools.partial(_trimmed_ascii, _PAYEE_LIMIT)),
+    ("M", functools.partial(_trimmed_ascii, _MEMO_LIMIT)),
+    ("L", _ascii),
+    ("N", _ascii),
+)
+
+
 def _format_qif_record(lines: Iterable[str]) -> List[str]:
+    # Called once per record; bind the per-field helpers locally
+    allowed = _ALLOWED_QIF_TAGS
+    ascii_ = _ascii
+    trim = _trim
     record: Dict[str, List[str]] = {}
     for entry in lines:
         if not entry:
             continue
         tag = entry[0]
         value = entry[1:]
-        if tag not in _ALLOWED_QIF_TAGS:
-            _LOG.warning("Dropping unsupported QIF tag '%s'", tag)
+        if tag not in allowed:
+            _warn("Unsupported QIF tags dropped", "Dropping unsupported QIF tag '%s'", tag)
             continue
         record.setdefault(tag, []).append(value)
 
@@ -117,143 +313,262 @@ def _format_qif_record(lines: Iterable[str]) -> List[str]:
     if "D" in record:
         formatted.append("D" + _sanitize_date(record["D"][0]))
     else:
-        _LOG.warning("QIF record missing date; Money may reject it")
+        _warn("QIF records missing a date; Money may reject them", "QIF record missing date")
     if "T" in record:
         formatted.append("T" + _sanitize_amount(record["T"][0]))
     else:
-        _LOG.warning("QIF record missing amount; Money may reject it")
-    if "P" in record:
-        payee = _trim(_ascii(record["P"][0]), _PAYEE_LIMIT)
-        formatted.append("P" + payee)
-    if "M" in record:
-        memo = _trim(_ascii(record["M"][0]), _MEMO_LIMIT)
-        formatted.append("M" + memo)
-    if "L" in record:
-        formatted.append("L" + _ascii(record["L"][0]))
-    if "N" in record:
-        formatted.append("N" + _ascii(record["N"][0]))
+        _warn("QIF records missing an amount; Money may reject them", "QIF record missing amount")
+    for tag, handler in _QIF_FIELDS:
+        if tag in record:
+            formatted.append(tag + handler(record[tag][0]))
 
     for tag in ("A",):
         for value in record.get(tag, []):
-            formatted.append(tag + _trim(_ascii(value), _ADDRESS_LIMIT))
+            formatted.append(tag + trim(ascii_(value), _ADDRESS_LIMIT))
 
     # Split details (S,E,O,$) must stay grouped and ordered
     splits = []
-    split_tags = ("S", "E", "O", "$")
-    max_len = max(len(record.get(t, [])) for t in split_tags) if any(record.get(t) for t in split_tags) else 0
-    for index in range(max_len):
-        for tag in split_tags:
-            values = record.get(tag, [])
-            if index < len(values):
-                cleaned = _ascii(values[index])
-                if tag == "$":
-                    cleaned = _sanitize_amount(cleaned)
-                splits.append(tag + cleaned)
+    split_lists = [(tag, record[tag]) for tag in ("S", "E", "O", "$") if tag in record]
+    if split_lists:
+        max_len = max(len(values) for _, values in split_lists)
+        for index in range(max_len):
+            for tag, values in split_lists:
+                if index < len(values):
+                    cleaned = ascii_(values[index])
+                    if tag == "$":
+                        cleaned = _sanitize_amount(cleaned)
+                    splits.append(tag + cleaned)
     formatted.extend(splits)
 
     return formatted
 
 
-def sanitize_qif(text: str) -> str:
+def _qif_type_header(line: str) -> str:
+    """Canonicalize a ``!Type`` line; a missing or empty type means a bank account."""
+    value = line.split(":", 1)[1].strip() if ":" in line else ""
+    header = _QIF_TYPE_HEADERS.get(value.lower())
+    if header is None:
+        header = f"!Type:{value.upper()}"
+    return header
+
+
+def _qif_lines(text: str) -> Iterator[str]:
+    """Yield sanitized QIF lines as each record is formatted."""
     content = text.replace("\r\n", "\n").replace("\r", "\n")
     lines = [line.strip() for line in content.split("\n")]
-    output: List[str] = []
     buffer: List[str] = []
     header = None
 
     for line in lines:
         if not line:
             continue
+        first = line[0]
+        # Most lines are fields; one character test sends them straight to the buffer
+        if first != "!" and first != "^":
+            buffer.append(line)
+            continue
         if line.startswith("!Type"):
             if buffer:
-                output.extend(_format_qif_record(buffer))
-                output.append("^")
+                yield from _format_qif_record(buffer)
+                yield "^"
                 buffer.clear()
-            header_value = line.split(":", 1)[1].strip().upper() if ":" in line else "BANK"
-            header = f"!Type:{header_value or 'BANK'}"
-            output.append(header)
+            header = _qif_type_header(line)
+            yield header
             continue
         if line == "^":
             if buffer:
-                output.extend(_format_qif_record(buffer))
+                yield from _format_qif_record(buffer)
             else:
-                _LOG.warning("Empty QIF record encountered")
-            output.append("^")
+                _warn("Empty QIF records encountered", "Empty QIF record encountered")
+            yield "^"
             buffer.clear()
             continue
         buffer.append(line)
 
     if buffer:
-        output.extend(_format_qif_record(buffer))
-        output.append("^")
+        yield from _format_qif_record(buffer)
+        yield "^"
 
     if header is None:
-        _LOG.warning("No QIF !Type header found; Money may refuse the file")
+        _warn("QIF files without a !Type header; Money may refuse them", "No QIF !Type header found")
 
+
+def _emit(lines: Iterable[str], out: TextIO | None) -> str | None:
+    """Join lines with CRLF endings, or write them to ``out`` as they arrive."""
     # Ensure CRLF endings as Money expects Windows line endings
-    return "\r\n".join(output) + "\r\n"
+    if out is None:
+        return "\r\n".join(lines) + "\r\n"
+    write = out.write
+    wrote = False
+    for line in lines:
+        write(line)
+        write("\r\n")
+        wrote = True
+    if not wrote:
+        write("\r\n")
+    return None
+
+
+def _run(convert: _Converter, text: str, out: TextIO | None) -> str | None:
+    """Run a converter under a fresh warning counter and log what it collected as summaries."""
+    counter: collections.Counter[str] = collections.Counter()
+    token = _WARNINGS.set(counter)
+    try:
+        return convert(text, out)
+    finally:
+        _WARNINGS.reset(token)
+        # Also reports whatever was found before a failure
+        _log_warnings(counter.items())
 
 
-def _escape_ampersands(text: str) -> str:
-    return re.sub(r"&(?!amp;|lt;|gt;|apos;|quot;)", "&amp;", text)
+def _convert_qif(text: str, out: TextIO | None) -> str | None:
+    return _emit(_qif_lines(text), out)
 
 
-def _ensure_trnuid(root: ET.Element) -> None:
-    fallback = None
-    for fit in root.findall(".//FITID"):
-        if fit.text and fit.text.strip():
-            fallback = fit.text.strip()
-            break
-    if fallback is None:
-        fallback = _dt.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+def sanitize_qif(text: str, out: TextIO | None = None) -> str | None:
+    """Sanitize QIF text; write to ``out`` instead of returning it when given."""
+    return _run(_convert_qif, text, out)
 
-    for node in root.findall(".//TRNUID"):
-        if not node.text or not node.text.strip():
-            node.text = fallback
 
+def _escape_ampersands(text: str) -> str:
+    # Most values carry no ampersand at all; skip the lookahead regex for them
+    if "&" not in text:
+        return text
+    return _AMP_RE.sub("&amp;", text)
+
+
+def _ofx_text(text: str) -> str:
+    if not text.isascii():
+        text = _fold_ascii(text)
+    return _escape_ampersands(text)
+
+
+def _ofx_pieces(body: str) -> Iterator[str]:
+    """Yield an OFX body prepared for the XML parser piece by piece, in a single pass.
+
+    Tag names are uppercased, leaf tags that have text content but no closing
+    tag are closed, and text is reduced to ASCII with bare ampersands escaped.
+    Line endings are left alone; the XML parser normalizes them itself.
+    """
+    # Typical bank output is plain ASCII without ampersands; skip per-chunk cleanup then.
+    # Otherwise NFKD only ever sees the individual text chunks that are not ASCII.
+    clean = body.isascii() and "&" not in body
+    size = len(body)
+    copied = 0
+    for match in _OFX_TOKEN_RE.finditer(body):
+        start = match.start()
+        if start != copied:
+            # Stray "<" (or leading text) that does not form a tag
+            yield _ofx_text(body[copied:start])
+        copied = match.end()
+        slash, name, suffix, text = match.groups()
+        name = name.upper()
+        if not clean:
+            suffix = _ofx_text(suffix)
+        if name and suffix and not suffix[0].isspace() and suffix[0] != "/":
+            # The name runs on past the tokenizer's character class (e.g. "ns:tag")
+            tail = _NAME_TAIL_RE.match(suffix).end()
+            suffix = suffix[:tail].upper() + suffix[tail:]
+        yield f"<{slash}{name}{suffix}>"
+        if not text:
+            continue
+        yield text if clean else _ofx_text(text)
+        # Close <TAG>Content<... when Content is not whitespace and the next tag is not </TAG>
+        if name and not slash and not suffix and copied != size and not text.isspace():
+            closing = f"</{name}>"
+            if body[copied : copied + len(closing)].upper() != closing:
+                yield closing
+    if copied != size:
+        yield _ofx_text(body[copied:])
+
+
+def _preprocess_ofx(body: str) -> str:
+    """Prepare a whole OFX body for the XML parser; see ``_ofx_pieces``."""
+    return "".join(_ofx_pieces(body))
+
+
+def _now_compact() -> str:
+    """Current UTC time as an OFX YYYYMMDDHHMMSS stamp."""
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime())
+
+
+@dataclasses.dataclass
+class _OfxContext:
+    """Document-wide facts collected in the single streaming pass over an OFX body."""
+
+    sonrs: ET.Element | None = None
+    stmtrs: ET.Element | None = None
+    balances: Dict[str, ET.Element] = dataclasses.field(default_factory=dict)
+    trnuids: List[ET.Element] = dataclasses.field(default_factory=list)
+    fitid: str | None = None
+    bank_id: str | None = None
+    # Open aggregates around the BANKACCTFROM that supplied bank_id; an enclosing
+    # BANKACCTFROM comes earlier in document order, so its own BANKID still wins
+    bank_path: List[ET.Element] = dataclasses.field(default_factory=list)
+    dtend: str | None = None
+    total_cents: int = 0
+    # One stamp per document, shared by every synthesized TRNUID and DTASOF
+    now: str = dataclasses.field(default_factory=_now_compact)
+
+
+def _ensure_trnuid(context: _OfxContext) -> str:
+    """Fill in every empty TRNUID, returning the value they were given."""
+    fallback = context.fitid
+    if fallback is None:
+        fallback = context.now
 
-def _ensure_balances(root: ET.Element) -> None:
-    stmtrs = root.find(".//STMTRS")
-    if stmtrs is None:
-        return
+    for node in context.trnuids:
+        node.text = fallback
+    return fallback
 
-    dtend = stmtrs.findtext(".//DTEND")
-    if not dtend:
-        dtend = _dt.datetime.utcnow().strftime("%Y%m%d")
 
-    total = 0.0
-    for trn in stmtrs.findall(".//STMTTRN"):
-        amount_text = (trn.findtext("TRNAMT") or "0").replace(",", "")
-        try:
-            total += float(amount_text)
-        except ValueError:
-            continue
+def _transaction_cents(trn: ET.Element) -> int:
+    """TRNAMT of one STMTTRN in cents; an amount that cannot be parsed counts as zero."""
+    return _amount_cents((trn.findtext("TRNAMT") or "0").replace(",", "").strip()) or 0
 
-    def _make_balance(tag: str) -> ET.Element:
-        existing = stmtrs.find(tag)
-        if existing is not None:
-            return existing
-        return ET.SubElement(stmtrs, tag)
 
+def _ensure_balances(context: _OfxContext) -> List[ET.Element]:
+    """Fill in LEDGERBAL/AVAILBAL of the first STMTRS, returning any newly created aggregates."""
+    dtend = context.dtend
+    if not dtend:
+        dtend = context.now[:8]
+
+    created: List[ET.Element] = []
     for balance_tag in ("LEDGERBAL", "AVAILBAL"):
-        balance = _make_balance(balance_tag)
+        balance = context.balances.get(balance_tag)
+        if balance is None:
+            balance = ET.Element(balance_tag)
+            created.append(balance)
         balamt = balance.find("BALAMT")
         if balamt is None:
             balamt = ET.SubElement(balance, "BALAMT")
-        balamt.text = f"{total:.2f}"
+        balamt.text = _format_cents(context.total_cents)
 
         dtasof = balance.find("DTASOF")
         if dtasof is None:
             dtasof = ET.SubElement(balance, "DTASOF")
         dtasof.text = dtend
+    return created
+
+
+def _ensure_nested_balances(context: _OfxContext, stmtrs: ET.Element) -> None:
+    """Fill in the balances of a first STMTRS that arrived whole inside a buffered aggregate."""
+    context.stmtrs = stmtrs
+    context.dtend = stmtrs.findtext(".//DTEND")
+    context.total_cents = sum(_transaction_cents(trn) for trn in stmtrs.iter("STMTTRN"))
+    for balance_tag in ("LEDGERBAL", "AVAILBAL"):
+        balance = stmtrs.find(balance_tag)
+        if balance is not None:
+            context.balances[balance_tag] = balance
+    # New aggregates go last, as the streamed path renders them at the end tag
+    stmtrs.extend(_ensure_balances(context))
 
 
-def _ensure_fi_info(root: ET.Element) -> None:
-    sonrs = root.find(".//SONRS")
+def _ensure_fi_info(context: _OfxContext) -> None:
+    sonrs = context.sonrs
     if sonrs is None:
         return
-
-    bank_id = root.findtext(".//BANKACCTFROM/BANKID", default="000000000").strip() or "000000000"
+    bank_id = (context.bank_id or "").strip() or "000000000"
     org = bank_id
 
     fi = sonrs.find("FI")
@@ -271,111 +586,309 @@ def _ensure_fi_info(root: ET.Element) -> None:
     intu_bid.text = bank_id
 
 
+def _sanitize_ofx_date(tag: str, raw: str) -> str:
+    # Banks nearly always send bare digits; only run the regex on anything else
+    digits = raw if raw.isdigit() and raw.isascii() else _DIGITS_RE.sub("", raw)
+    if len(digits) < 8:
+        _warn("OFX dates with unexpected values", "Date-like tag %s has unexpected value '%s'", tag, raw)
+    return digits or raw
+
+
+# Per-tag value handlers; any other tag is just reduced to ASCII
+_OFX_HANDLERS: Dict[str, Callable[[str], str]] = {
+    "TRNAMT": _sanitize_amount,
+    **{tag: functools.partial(_sanitize_ofx_date, tag) for tag in ("DTPOSTED", "DTSTART", "DTEND", "DTASOF")},
+    **{tag: functools.partial(_trimmed_ascii, limit) for tag, limit in _OFX_TAG_LIMITS.items()},
+}
+
+
 def _sanitize_ofx_value(tag: str, value: str) -> str:
+    """Sanitize the text of an OFX leaf; ``tag`` must already be uppercase."""
     raw = value.strip()
     if not raw:
         return ""
-
-    upper_tag = tag.upper()
-    if upper_tag == "TRNAMT":
-        return _sanitize_amount(raw)
-    if upper_tag in {"DTPOSTED", "DTSTART", "DTEND", "DTASOF"}:
-        digits = re.sub(r"[^0-9]", "", raw)
-        if len(digits) < 8:
-            _LOG.warning("Date-like tag %s has unexpected value '%s'", upper_tag, raw)
-        return digits or raw
-
-    sanitized = _ascii(raw)
-    limit = _OFX_TAG_LIMITS.get(upper_tag)
-    if limit:
-        sanitized = _trim(sanitized, limit)
-    return sanitized
+    return _OFX_HANDLERS.get(tag, _ascii)(raw)
 
 
 def _ofx_element_to_sgml(elem: ET.Element) -> List[str]:
     lines: List[str] = []
+    append = lines.append
+    # _sanitize_ofx_value() inlined: this loop runs for every node of every transaction
+    handler = _OFX_HANDLERS.get
+    default = _ascii
+    # Iterative pre-order walk; closing tags ride on the stack as plain strings
+    stack: List[ET.Element | str] = [elem]
+    pop = stack.pop
+
+    while stack:
+        node = pop()
+        if isinstance(node, str):
+            append(node)
+            continue
+        tag = node.tag
+        raw = node.text
+        text = handler(tag, default)(raw.strip()) if raw and not raw.isspace() else ""
 
-    def _walk(node: ET.Element) -> None:
-        tag = node.tag.upper()
-        children = list(node)
-        text = _sanitize_ofx_value(tag, node.text or "")
-
-        if children:
-            lines.append(f"<{tag}>")
+        if len(node):
+            append(f"<{tag}>")
             if text:
-                lines.append(text)
-            for child in children:
-                _walk(child)
-            lines.append(f"</{tag}>")
-        else:
-            if text:
-                lines.append(f"<{tag}>{text}")
-            else:
-                # Drop empty leaf nodes; Money prefers them omitted entirely
-                return
+                append(text)
+            stack.append(f"</{tag}>")
+            stack.extend(reversed(node))
+        elif text:
+            append(f"<{tag}>{text}")
+        # Empty leaf nodes are dropped; Money prefers them omitted entirely
 
-    _walk(elem)
     return lines
 
 
-def sanitize_ofx(text: str) -> str:
-    body_start = text.upper().find("<OFX")
-    if body_start == -1:
+def _stream_ofx(chunks: Iterable[str]) -> List[str]:
+    """Convert OFX XML, fed in chunks, to SGML lines without keeping the whole tree.
+
+    Parse events are consumed as they arrive and every finished element is
+    cleared. Document-wide rules match a whole-tree pass: the first SONRS and
+    the first STMTRS in document order get FI and balance data, and every empty
+    TRNUID gets the fallback. Buffered aggregates holding any of those are kept
+    until that context is known; they are rendered into reserved slots.
+    """
+    lines: List[str] = []
+    deferred: Dict[int, ET.Element] = {}
+    # Places for the text of aggregate TRNUIDs that arrived without any
+    trnuid_slots: List[int] = []
+    stack: List[ET.Element] = []
+    opened: List[bool] = []
+    held: ET.Element | None = None
+    context = _OfxContext()
+    in_stmtrs = False
+    append = lines.append
+    sanitize = _sanitize_ofx_value
+    noted = _CONTEXT_TAGS
+
+    def _take_bank_id(value: str, path: List[ET.Element]) -> None:
+        # path ends with the BANKACCTFROM the BANKID belongs to
+        if context.bank_id is None or any(node is path[-1] for node in context.bank_path):
+            context.bank_id = value
+            context.bank_path = path[:-1]
+
+    def _note(tag: str, value: str, parents: List[ET.Element]) -> None:
+        """Record document context from a streamed element's text, which arrives in document order."""
+        if tag == "FITID":
+            if context.fitid is None and value.strip():
+                context.fitid = value.strip()
+        elif tag == "DTEND":
+            if context.dtend is None and in_stmtrs:
+                context.dtend = value
+        elif parents and parents[-1].tag == "BANKACCTFROM":
+            _take_bank_id(value, parents)
+
+    def _scan(node: ET.Element) -> bool:
+        """Record document context from a finished buffered subtree; True if it must be kept."""
+        keep = False
+        if context.fitid is None:
+            for fit in node.iter("FITID"):
+                if fit.text and fit.text.strip():
+                    context.fitid = fit.text.strip()
+                    break
+        if context.bank_id is None:
+            for account in node.iter("BANKACCTFROM"):
+                bank = account.find("BANKID")
+                if bank is not None:
+                    context.bank_id = bank.text or ""
+                    context.bank_path = list(stack)
+                    break
+        if in_stmtrs:
+            if context.dtend is None:
+                for dtend in node.iter("DTEND"):
+                    context.dtend = dtend.text or ""
+                    break
+            for trn in node.iter("STMTTRN"):
+                context.total_cents += _transaction_cents(trn)
+        if context.sonrs is None:
+            for sonrs in node.iter("SONRS"):
+                context.sonrs = sonrs
+                keep = True
+                break
+        if context.stmtrs is None:
+            for stmtrs in node.iter("STMTRS"):
+                _ensure_nested_balances(context, stmtrs)
+                keep = True
+                break
+        for trnuid in node.iter("TRNUID"):
+            if not (trnuid.text and trnuid.text.strip()):
+                context.trnuids.append(trnuid)
+                keep = True
+        tag = node.tag
+        if tag in _BALANCE_TAGS and stack and stack[-1] is context.stmtrs and tag not in context.balances:
+            context.balances[tag] = node
+            keep = True
+        return keep
+
+    def _open(node: ET.Element) -> None:
+        tag = node.tag
+        append(f"<{tag}>")
+        value = node.text or ""
+        text = sanitize(tag, value)
+        if text:
+            append(text)
+        elif tag == "TRNUID" and not value.strip():
+            trnuid_slots.append(len(lines))
+            append("")
+        if tag in noted:
+            _note(tag, value, stack[:-1])
+
+    def _defer(node: ET.Element) -> None:
+        deferred[len(lines)] = node
+        lines.append("")
+
+    def _release(node: ET.Element, keep: bool) -> None:
+        if not keep:
+            node.clear()
+        # Earlier siblings are finished; drop them so the tree stays shallow
+        if stack and stack[-1][0] is not node:
+            del stack[-1][0]
+
+    parser = ET.XMLPullParser(events=("start", "end"))
+
+    def _events() -> Iterator[tuple]:
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    for event, elem in _events():
+        if held is not None:
+            if event == "start" or elem is not held:
+                continue
+            held = None
+            keep = _scan(elem)
+            if keep:
+                _defer(elem)
+            else:
+                lines.extend(_ofx_element_to_sgml(elem))
+            _release(elem, keep)
+            continue
+
+        if event == "start":
+            if stack and not opened[-1]:
+                _open(stack[-1])
+                opened[-1] = True
+            tag = elem.tag
+            if tag in _BUFFERED_TAGS:
+                held = elem
+                continue
+            if tag == "STMTRS" and context.stmtrs is None:
+                context.stmtrs = elem
+                in_stmtrs = True
+            stack.append(elem)
+            opened.append(False)
+            continue
+
+        stack.pop()
+        is_open = opened.pop()
+        tag = elem.tag
+        keep = False
+        if elem is context.stmtrs:
+            in_stmtrs = False
+            if not is_open:
+                _open(elem)
+                is_open = True
+            for balance in _ensure_balances(context):
+                lines.extend(_ofx_element_to_sgml(balance))
+
+        if is_open:
+            append(f"</{tag}>")
+        elif tag == "TRNUID" and not (elem.text and elem.text.strip()):
+            context.trnuids.append(elem)
+            keep = True
+            _defer(elem)
+        else:
+            value = elem.text or ""
+            if tag in noted:
+                _note(tag, value, stack)
+            text = sanitize(tag, value)
+            # Drop empty leaf nodes; Money prefers them omitted entirely
+            if text:
+                append(f"<{tag}>{text}")
+        _release(elem, keep)
+
+    trnuid_text = sanitize("TRNUID", _ensure_trnuid(context))
+    for index in trnuid_slots:
+        lines[index] = trnuid_text
+    _ensure_fi_info(context)
+
+    sgml: List[str] = []
+    for index, line in enumerate(lines):
+        node = deferred.get(index)
+        if node is not None:
+            sgml.extend(_ofx_element_to_sgml(node))
+        elif line:
+            sgml.append(line)
+    return sgml
+
+
+def _convert_ofx(text: str, out: TextIO | None) -> str | None:
+    # Same bounded window as sanitize_file(); the root follows a short header
+    root = _OFX_SIGNATURE_RE.search(text, 0, _SIGNATURE_WINDOW)
+    if root is None:
         raise ValueError("Input does not contain an <OFX> root element")
 
-    body = text[body_start:]
-    body = body.replace("\r\n", "\n").replace("\r", "\n")
-    body = _escape_ampersands(body)
-
-    def _upper_tag(match: re.Match[str]) -> str:
-        prefix = match.group(1)
-        tag = match.group(2).upper()
-        suffix = match.group(3)
-        return f"<{prefix}{tag}{suffix}>"
-
-    body = re.sub(r"<(/?)([A-Za-z0-9_.+-]+)([^>]*)>", _upper_tag, body)
-
-    # Fix SGML: Close leaf tags that have text content but no closing tag
-    # Matches <TAG>Content<... where Content is not whitespace and next char is < but not </TAG>
-    # Content must not contain <. \S matches < so we use [^<\s] to ensure we don't match start of next tag.
-    body = re.sub(
-        r"<([A-Z0-9_.+-]+)>([^<]*[^<\s][^<]*)(?=<(?!/\1>))",
-        r"<\1>\2</\1>",
-        body,
-        flags=re.IGNORECASE,
-    )
-
-    body = unicodedata.normalize("NFKD", body).encode("ascii", "ignore").decode("ascii", "ignore")
+    body = text[root.start():]
+    if len(body) < 64 and body.rstrip().upper() == "<OFX></OFX>":
+        # An empty root renders to the bare header; no need to start a parser
+        if out is None:
+            return _CANONICAL_HEADER
+        out.write(_CANONICAL_HEADER)
+        return None
+
+    # Feed the parser batches of preprocessed pieces; the cleaned body is never joined
+    pieces = _ofx_pieces(body)
+    chunks = iter(lambda: "".join(itertools.islice(pieces, _FEED_PIECES)), "")
     try:
-        root = ET.fromstring(body)
+        lines = _stream_ofx(chunks)
     except ET.ParseError as exc:  # noqa: B904 - include context
         raise ValueError(f"Unable to parse OFX XML: {exc}") from exc
 
-    _ensure_trnuid(root)
-    _ensure_balances(root)
-    _ensure_fi_info(root)
-    lines = _ofx_element_to_sgml(root)
-    sanitized = _HEADER_TEMPLATE + lines
-    return "\r\n".join(sanitized) + "\r\n"
+    return _emit(itertools.chain(_HEADER_TEMPLATE, lines), out)
 
 
-def _read_text(path: Path) -> str:
+def sanitize_ofx(text: str, out: TextIO | None = None) -> str | None:
+    """Sanitize OFX text; write to ``out`` instead of returning it when given."""
+    return _run(_convert_ofx, text, out)
+
+
+def _decode(data: bytes | mmap.mmap, path: Path) -> str:
     try:
-        return path.read_text(encoding="utf-8")
+        return str(data, "utf-8")
     except UnicodeDecodeError:
         _LOG.info("Falling back to latin-1 decoding for %s", path)
-        return path.read_text(encoding="latin-1")
+        return str(data, "latin-1")
+
+
+def _read_text(path: Path) -> str:
+    # Line endings are kept as-is; both converters normalize them on their own
+    with path.open("rb") as handle:
+        if os.fstat(handle.fileno()).st_size < _MMAP_THRESHOLD:
+            return _decode(handle.read(), path)
+        # Decode large statements straight from the page cache, skipping the bytes copy
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _decode(mapped, path)
 
 
-def sanitize_file(input_path: Path) -> str:
+def sanitize_file(input_path: Path, out: TextIO | None = None) -> str | None:
     text = _read_text(input_path)
     
-    # Detect OFX/QFX by content signature
-    if "<OFX" in text.upper():
-        return sanitize_ofx(text)
+    # Detect OFX/QFX by content signature: the root tag or the SGML header
+    head = text[:_SIGNATURE_WINDOW].lstrip()
+    if _OFX_SIGNATURE_RE.search(text, 0, _SIGNATURE_WINDOW) or head.startswith("OFXHEADER"):
+        return sanitize_ofx(text, out)
+
+    # Neither signature: trust an OFX suffix so the error names the real problem
+    if not head.startswith("!") and input_path.suffix.lower() in _OFX_SUFFIXES:
+        return sanitize_ofx(text, out)
         
     # Default to QIF processing
-    return sanitize_qif(text)
+    return sanitize_qif(text, out)
 
 
 def _configure_logging(verbose: bool) -> None:
@@ -410,15 +923,24 @@ def _parse_args(argv: List[str]) -> argparse.Namespace:
 def main(argv: List[str] | None = None) -> int:
     args = _parse_args(argv or sys.argv[1:])
     _configure_logging(args.verbose)
+    # Write through a symlinked destination (e.g. --in-place on a link) to the real file
+    target = args.output.resolve()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Stream into a sibling file and swap it in, so --in-place never reads a
+    # half-written source and a failure leaves the destination untouched
+    partial = target.with_name(target.name + ".partial")
     try:
-        sanitized = sanitize_file(args.input)
+        with partial.open("w", encoding="ascii", newline="") as handle:
+            if target.exists():
+                # Keep the destination's permissions; statements are often private (0600)
+                shutil.copymode(target, partial)
+            sanitize_file(args.input, handle)
     except Exception as exc:  # noqa: BLE001 - surface to CLI
+        partial.unlink(missing_ok=True)
         _LOG.error("Failed to sanitize %s: %s", args.input, exc)
         return 1
 
-    args.output.parent.mkdir(parents=True, exist_ok=True)
-    with args.output.open("w", encoding="ascii", newline="") as handle:
-        handle.write(sanitized)
+    os.replace(partial, target)
     _LOG.info("Sanitized file written to %s", args.output)
     return 0
 
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 """Exhaustive test suite for sanitize-ofx.py covering MS Money OFX and QIF formats."""
 
+import io
+import os
 import pytest
+import stat
 import tempfile
+import threading
+import timeit
 from pathlib import Path
 
 from sanitize_ofx import (
@@ -14,7 +19,9 @@ from sanitize_ofx import (
     sanitize_qif,
     sanitize_ofx,
     sanitize_file,
+    main,
     _escape_ampersands,
+    _preprocess_ofx,
     _sanitize_ofx_value,
 )
 
@@ -55,6 +62,11 @@ class TestAscii:
     def test_leading_trailing_spaces(self):
         assert _ascii("  trimmed  ") == "trimmed"
 
+    def test_tabs_and_newlines_idempotent(self):
+        once = _ascii("\tcol1\t\tcol2\n\ncol3 \r\n")
+        assert once == "col1 col2 col3"
+        assert _ascii(once) == once
+
     def test_empty_string(self):
         assert _ascii("") == ""
 
@@ -131,6 +143,18 @@ class TestSanitizeAmount:
     def test_negative_with_comma(self):
         assert _sanitize_amount("-1,234.56") == "-1234.56"
 
+    def test_rounds_half_up(self):
+        assert _sanitize_amount("2.675") == "2.68"
+        assert _sanitize_amount("-1.005") == "-1.01"
+
+    def test_exponent(self):
+        assert _sanitize_amount("1e2") == "100.00"
+
+    @pytest.mark.parametrize("amount", ["nan", "inf", "-Infinity", "1e9999999", "1e999999", "1e5000"])
+    def test_non_finite_or_out_of_range_rejected(self, amount):
+        with pytest.raises(ValueError, match="Unparseable amount"):
+            _sanitize_amount(amount)
+
 
 class TestTrim:
     """Tests for _trim() function."""
@@ -164,6 +188,41 @@ class TestEscapeAmpersands:
     def test_mixed(self):
         assert _escape_ampersands("A & B &amp; C") == "A &amp; B &amp; C"
 
+    def test_no_ampersand(self):
+        assert _escape_ampersands("A and B") == "A and B"
+
+
+class TestPreprocessOfx:
+    """Tests for _preprocess_ofx() function."""
+
+    def test_closes_unterminated_leaf(self):
+        assert _preprocess_ofx("<CODE>0\n<SEVERITY>INFO\n</STATUS>") == (
+            "<CODE>0\n</CODE><SEVERITY>INFO\n</SEVERITY></STATUS>"
+        )
+
+    def test_existing_closing_tag_untouched(self):
+        assert _preprocess_ofx("<NAME>Store</name><MEMO>x</MEMO>") == "<NAME>Store</NAME><MEMO>x</MEMO>"
+
+    def test_aggregates_and_trailing_text_untouched(self):
+        assert _preprocess_ofx("<OFX>\n<STMTTRN>\n</STMTTRN>\n</OFX>") == "<OFX>\n<STMTTRN>\n</STMTTRN>\n</OFX>"
+        assert _preprocess_ofx("<NAME>no tag follows") == "<NAME>no tag follows"
+
+    def test_uppercases_tags_and_cleans_text(self):
+        assert _preprocess_ofx("<name>Café & Co</name>") == "<NAME>Cafe &amp; Co</NAME>"
+
+    def test_ascii_body_with_ampersand(self):
+        assert _preprocess_ofx("<NAME>AT&T<MEMO>A &amp; B</MEMO>") == "<NAME>AT&amp;T</NAME><MEMO>A &amp; B</MEMO>"
+
+    def test_stray_lt_before_long_run_is_linear(self):
+        # A "<" that never closes must not make the tokenizer backtrack over the run
+        def best_time(size):
+            body = "<OFX><MEMO>a<" + "b" * size + "</MEMO></OFX>"
+            assert _preprocess_ofx(body) == "<OFX><MEMO>a</MEMO><" + "b" * size + "</MEMO></OFX>"
+            return min(timeit.repeat(lambda: _preprocess_ofx(body), number=1, repeat=3))
+
+        # Four times the input costs about 4x when linear and 16x when quadratic
+        assert best_time(20000) < 10 * best_time(5000)
+
 
 class TestSanitizeOfxValue:
     """Tests for _sanitize_ofx_value() function."""
@@ -416,6 +475,34 @@ class TestQifEdgeCases:
             result = sanitize_qif(qif)
             assert "D01/15'23" in result
 
+    def test_repeated_warnings_summarized(self, caplog):
+        qif = "!Type:Bank\n" + "D01/15/2023\nT100.00\nXUnsupported\n^\n" * 3
+        with caplog.at_level("WARNING"):
+            sanitize_qif(qif)
+        assert [r.getMessage() for r in caplog.records] == ["Unsupported QIF tags dropped: 3"]
+
+    def test_concurrent_runs_keep_their_own_warnings(self, caplog):
+        qif = "!Type:Bank\n" + "D01/15/2023\nT100.00\nXUnsupported\n^\n" * 2000
+        threads = [threading.Thread(target=sanitize_qif, args=(qif, io.StringIO())) for _ in range(8)]
+        with caplog.at_level("WARNING"):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert [r.getMessage() for r in caplog.records] == ["Unsupported QIF tags dropped: 2000"] * 8
+
+    def test_repeat_run_same_result_and_warnings(self, caplog):
+        qif = "!Type:Bank\nD01/15/2023\nT$12.50\nYbogus\n^"
+        with caplog.at_level("WARNING"):
+            first = sanitize_qif(qif)
+            logged = [r.getMessage() for r in caplog.records]
+            caplog.clear()
+            assert sanitize_qif(qif) == first
+        assert [r.getMessage() for r in caplog.records] == logged == [
+            "Unsupported QIF tags dropped: 1",
+            "Amounts needing coercion: 1",
+        ]
+
 
 # =============================================================================
 # OFX Format Tests
@@ -454,6 +541,10 @@ class TestOfxBasic:
         assert "\r\n" in result
         assert result.endswith("\r\n")
 
+    def test_empty_root_matches_general_path(self):
+        # The header-only shortcut must agree with a full parse of an empty root
+        assert sanitize_ofx("<OFX></OFX>") == sanitize_ofx("<OFX>\n</OFX>")
+
 
 class TestOfxTransactions:
     """Tests for OFX transaction handling."""
@@ -597,6 +688,17 @@ class TestOfxBalances:
         # Balance should be 1000 - 300 - 200 = 500
         assert "<BALAMT>500.00" in result
 
+    def test_first_stmtrs_inside_buffered_aggregate(self):
+        # The first STMTRS in document order gets the balances, wherever it is nested
+        ofx = """<OFX>
+<SONRS><STMTRS><STMTTRN><TRNAMT>4.00</TRNAMT></STMTTRN></STMTRS></SONRS>
+<STMTRS><STMTTRN><TRNAMT>9.00</TRNAMT></STMTTRN></STMTRS>
+</OFX>"""
+        lines = sanitize_ofx(ofx).split("\r\n")
+        assert lines.count("<LEDGERBAL>") == 1
+        assert lines.count("<BALAMT>4.00") == 2
+        assert lines.index("</LEDGERBAL>") < lines.index("</SONRS>")
+
 
 class TestOfxFinancialInstitution:
     """Tests for OFX financial institution info."""
@@ -619,6 +721,17 @@ class TestOfxFinancialInstitution:
         assert "<FID>123456789" in result
         assert "<INTU.BID>123456789" in result
 
+    def test_sonrs_nested_in_transaction(self):
+        ofx = """<OFX>
+<BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<BANKACCTFROM><BANKID>123</BANKID></BANKACCTFROM>
+<STMTTRN><SONRS><CODE>0</CODE></SONRS></STMTTRN>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        result = sanitize_ofx(ofx)
+        assert "<FID>123" in result
+        assert "<INTU.BID>123\r\n</SONRS>" in result
+
 
 class TestOfxTrnuid:
     """Tests for OFX TRNUID handling."""
@@ -652,6 +765,38 @@ class TestOfxTrnuid:
         result = sanitize_ofx(ofx)
         assert "<TRNUID>EXISTING123" in result
 
+    def test_timestamp_fallback_matches_balance_date(self):
+        ofx = """<OFX>
+<BANKMSGSRSV1><STMTTRNRS>
+<TRNUID></TRNUID>
+<STMTRS></STMTRS>
+</STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        lines = sanitize_ofx(ofx).split("\r\n")
+        stamp = next(line[len("<TRNUID>"):] for line in lines if line.startswith("<TRNUID>"))
+        assert len(stamp) == 14 and stamp.isdigit()
+        assert f"<DTASOF>{stamp[:8]}" in lines
+
+    def test_empty_trnuid_inside_transaction_filled(self):
+        # The TRNUID arrives inside a buffered STMTTRN; the FITID after it still wins
+        ofx = """<OFX>
+<BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNUID></TRNUID><TRNAMT>1.00</TRNAMT></STMTTRN>
+<STMTTRN><TRNAMT>2.00</TRNAMT><FITID>LATER</FITID></STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        result = sanitize_ofx(ofx)
+        assert "<STMTTRN>\r\n<TRNUID>LATER\r\n<TRNAMT>1.00\r\n</STMTTRN>" in result
+
+    def test_empty_trnuid_with_children_filled(self):
+        ofx = """<OFX>
+<BANKMSGSRSV1><STMTTRNRS><TRNUID><CODE>0</CODE></TRNUID>
+<STMTRS><BANKTRANLIST><STMTTRN><FITID>T1</FITID></STMTTRN></BANKTRANLIST></STMTRS>
+</STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        result = sanitize_ofx(ofx)
+        assert "<TRNUID>\r\nT1\r\n<CODE>0\r\n</TRNUID>" in result
+
 
 class TestOfxFieldTruncation:
     """Tests for OFX field length limits."""
@@ -764,6 +909,31 @@ class TestOfxAmountHandling:
         result = sanitize_ofx(ofx)
         assert "<TRNAMT>1234.56" in result
 
+    def test_out_of_range_amount_rejected(self):
+        ofx = """<OFX>
+<BANKMSGSRSV1><STMTTRNRS><TRNUID>1</TRNUID><STMTRS>
+<BANKTRANLIST>
+<STMTTRN><TRNAMT>1e5000</TRNAMT><FITID>T1</FITID></STMTTRN>
+<STMTTRN><TRNAMT>10.00</TRNAMT><FITID>T2</FITID></STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        with pytest.raises(ValueError, match="Unparseable amount"):
+            sanitize_ofx(ofx)
+
+    def test_huge_plain_amount_rejected(self):
+        # Past int()'s digit limit; rejected like any other out-of-range amount
+        ofx = f"""<OFX>
+<BANKMSGSRSV1><STMTTRNRS><TRNUID>1</TRNUID><STMTRS>
+<BANKTRANLIST>
+<STMTTRN><TRNAMT>{"9" * 5000}</TRNAMT><FITID>T1</FITID></STMTTRN>
+<STMTTRN><TRNAMT>10.00</TRNAMT><FITID>T2</FITID></STMTTRN>
+</BANKTRANLIST>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>"""
+        with pytest.raises(ValueError, match="Unparseable amount"):
+            sanitize_ofx(ofx)
+
 
 class TestOfxDateHandling:
     """Tests for OFX date formatting."""
@@ -837,6 +1007,10 @@ class TestOfxEdgeCases:
         with pytest.raises(ValueError, match="does not contain an <OFX>"):
             sanitize_ofx("<INVALID></INVALID>")
 
+    def test_root_must_follow_short_header(self):
+        with pytest.raises(ValueError, match="does not contain an <OFX>"):
+            sanitize_ofx("X" * 5000 + "<OFX></OFX>")
+
     def test_unicode_handling(self):
         ofx = """<OFX>
 <BANKMSGSRSV1><STMTTRNRS><TRNUID>1</TRNUID><STMTRS>
@@ -1029,6 +1203,83 @@ class TestSanitizeFile:
             assert "OFXHEADER:100" in result
             Path(f.name).unlink()
 
+    def test_ofx_suffix_without_root(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.qfx', delete=False) as f:
+            f.write("OFXHEADER:100\nDATA:OFXSGML\n")
+            f.flush()
+            with pytest.raises(ValueError, match="does not contain an <OFX>"):
+                sanitize_file(Path(f.name))
+            Path(f.name).unlink()
+
+    def test_ofx_header_without_root_in_txt(self):
+        # The SGML header is a signature too; such a file must not fall through to QIF
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
+            f.write("OFXHEADER:100\nDATA:OFXSGML\n" + " " * 5000 + "<OFX></OFX>")
+            f.flush()
+            with pytest.raises(ValueError, match="does not contain an <OFX>"):
+                sanitize_file(Path(f.name))
+            Path(f.name).unlink()
+
+    def test_qif_content_wins_over_suffix(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ofx', delete=False) as f:
+            f.write("!Type:Bank\nD01/15/2023\nT100.00\n^")
+            f.flush()
+            assert "!Type:BANK" in sanitize_file(Path(f.name))
+            Path(f.name).unlink()
+
+    def test_lowercase_ofx_detection(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
+            f.write("OFXHEADER:100\n\n<ofx><signonmsgsrsv1></signonmsgsrsv1></ofx>")
+            f.flush()
+            result = sanitize_file(Path(f.name))
+            assert "<OFX>" in result
+            Path(f.name).unlink()
+
+    def test_large_latin1_file(self):
+        record = "D01/15/2023\nT100.00\nPCaf\xe9\n^\n"
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.qif', delete=False) as f:
+            f.write(("!Type:Bank\n" + record * 40000).encode("latin-1"))
+            f.flush()
+            result = sanitize_file(Path(f.name))
+            assert result.count("PCafe\r\n") == 40000
+            Path(f.name).unlink()
+
+    def test_writes_to_stream(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.qif', delete=False) as f:
+            f.write("!Type:Bank\nD01/15/2023\nT100.00\n^")
+            f.flush()
+            out = io.StringIO()
+            assert sanitize_file(Path(f.name), out) is None
+            assert out.getvalue() == sanitize_file(Path(f.name))
+            Path(f.name).unlink()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX permissions and symlinks")
+class TestMain:
+    """Tests for the command-line entry point."""
+
+    QIF = "!Type:Bank\nD01/15/2023\nT100.00\n^"
+
+    def test_in_place_keeps_mode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "statement.qif"
+            source.write_text(self.QIF)
+            source.chmod(0o600)
+            assert main(["-i", str(source), "--in-place"]) == 0
+            assert stat.S_IMODE(source.stat().st_mode) == 0o600
+            assert "D01/15'23" in source.read_text()
+
+    def test_in_place_writes_through_symlink(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            real = Path(tmp) / "real.qif"
+            real.write_text(self.QIF)
+            link = Path(tmp) / "link.qif"
+            link.symlink_to(real)
+            assert main(["-i", str(link), "--in-place"]) == 0
+            assert link.is_symlink()
+            assert "D01/15'23" in real.read_text()
+            assert sorted(p.name for p in Path(tmp).iterdir()) == ["link.qif", "real.qif"]
+
 
 # =============================================================================
 # MS Money Specific Format Tests
@@ -1273,6 +1524,15 @@ MTest Memo
         assert "<OFX>" in result
         assert "</OFX>" in result
 
+        out = io.StringIO()
+        sanitize_ofx(original, out)
+        assert out.getvalue() == result
+
+    def test_stream_empty_qif(self):
+        out = io.StringIO()
+        sanitize_qif("", out)
+        assert out.getvalue() == sanitize_qif("")
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])